@@ -1,10 +1,17 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import yfinance as yf
 import plotly.express as px
 from datetime import datetime
 from streamlit_gsheets import GSheetsConnection
+from gspread.exceptions import WorksheetNotFound
 import re
+import os
+import threading
+import time
+import json
+import hashlib
 
 # ==========================================================
 # 1. 系統設定 & 登入驗證
@@ -129,7 +136,7 @@ TRADELOG_COLS = [
     "手續費","交易稅","價金(原幣)",
     "成本(原幣)※賣出需填",
     "應收付(原幣)","損益(原幣)","市值(新台幣)","報酬率",
-    "建立時間"
+    "建立時間","交易ID"
 ]
 
 # ✅ 初始值（用 dict 方式，避免欄位變動造成長度不符）
@@ -158,6 +165,64 @@ conn = st.connection("gsheets", type=GSheetsConnection)
 # ==========================================================
 # 3. 核心運算引擎 (銀行存摺模式)
 # ==========================================================
+def _clean_num(x):
+    try:
+        return float(str(x).replace(",", ""))
+    except:
+        return 0.0
+
+def new_position(sym: str, row) -> dict:
+    return {
+        "shares": 0.0,
+        "cost": 0.0,
+        "currency": str(row.get("幣別", "")).strip().upper() or infer_currency(sym),
+        "name": (str(row.get("名稱", "")).strip() or sym)
+    }
+
+def apply_trade_to_position(pos: dict, row):
+    # ✅ 平均成本法：買入加成本；賣出依「成本欄」或平均成本扣除
+    q_b = _clean_num(row.get("買入股數", 0))
+    q_s = _clean_num(row.get("賣出股數", 0))
+
+    row_cost_field = _clean_num(row.get("成本(原幣)※賣出需填", 0))
+    buy_price = _clean_num(row.get("買入價格", 0))
+
+    if q_b > 0:
+        buy_cost = row_cost_field if row_cost_field > 0 else (buy_price * q_b)
+        pos["shares"] += q_b
+        pos["cost"] += buy_cost
+
+    if q_s > 0:
+        avg = pos["cost"] / pos["shares"] if pos["shares"] > 0 else 0.0
+        sell_cost = row_cost_field if row_cost_field > 0 else (avg * q_s)
+        pos["shares"] = max(0.0, pos["shares"] - q_s)
+        pos["cost"] = max(0.0, pos["cost"] - sell_cost)
+
+def make_holding_row(s: str, d: dict, now_p: float, prev_p: float, rate: float) -> dict:
+    m = get_mapping(s)
+    fx = rate if d["currency"] == "USD" else 1.0
+    mv_org = d["shares"] * now_p
+    return {
+        "投資組合": m["組合"],
+        "代號": s,
+        "名稱": d["name"],
+        "資產類別": m["類別"],
+        "投資地區": m["地區"],
+        "幣別": d["currency"],
+        "持有股數": d["shares"],
+        "平均成本(原幣)": d["cost"] / d["shares"] if d["shares"] > 0 else 0.0,
+        "目前市價(原幣)": now_p,
+        "日漲跌(%)": ((now_p / prev_p - 1.0) * 100.0) if (prev_p > 0 and now_p > 0) else 0.0,
+        "總成本(原幣)": d["cost"],
+        "總市值(原幣)": mv_org,
+        "未實現損益(原幣)": mv_org - d["cost"],
+        # ✅ 報酬率：直接存百分比數值（例如 12.34 = 12.34%）
+        "報酬率": ((mv_org - d["cost"]) / d["cost"] * 100.0) if d["cost"] > 0 else 0.0,
+        "匯率": fx,
+        "總市值(TWD)": mv_org * fx,
+        "未實現損益(TWD)": (mv_org - d["cost"]) * fx,
+    }
+
 def rebuild_data():
     df_l = conn.read(worksheet="trade_logs", ttl=0)
 
@@ -205,12 +270,6 @@ def rebuild_data():
 
     inventory = {}
 
-    def clean(x):
-        try:
-            return float(str(x).replace(",", ""))
-        except:
-            return 0.0
-
     # ✅ inventory 依「代號」聚合（現階段版本）
     for _, row in df_l.iterrows():
         sym = str(row.get("股票代號", "")).strip()
@@ -219,32 +278,11 @@ def rebuild_data():
         sym = normalize_symbol(sym)
 
         if sym not in inventory:
-            inventory[sym] = {
-                "shares": 0.0,
-                "cost": 0.0,
-                "currency": str(row.get("幣別", "")).strip().upper() or infer_currency(sym),
-                "name": (str(row.get("名稱", "")).strip() or sym)
-            }
-
-        q_b = clean(row.get("買入股數", 0))
-        q_s = clean(row.get("賣出股數", 0))
-
-        row_cost_field = clean(row.get("成本(原幣)※賣出需填", 0))
-        buy_price = clean(row.get("買入價格", 0))
-
-        if q_b > 0:
-            buy_cost = row_cost_field if row_cost_field > 0 else (buy_price * q_b)
-            inventory[sym]["shares"] += q_b
-            inventory[sym]["cost"] += buy_cost
-
-        if q_s > 0:
-            avg = inventory[sym]["cost"] / inventory[sym]["shares"] if inventory[sym]["shares"] > 0 else 0.0
-            sell_cost = row_cost_field if row_cost_field > 0 else (avg * q_s)
-            inventory[sym]["shares"] = max(0.0, inventory[sym]["shares"] - q_s)
-            inventory[sym]["cost"] = max(0.0, inventory[sym]["cost"] - sell_cost)
+            inventory[sym] = new_position(sym, row)
+        apply_trade_to_position(inventory[sym], row)
 
     symbols = list(inventory.keys())
-    prices, rate = {}, 31.5
+    prices, prev_prices, rate = {}, {}, 31.5
     if symbols:
         try:
             t = yf.Tickers(" ".join(symbols + ["TWD=X"]))
@@ -252,8 +290,11 @@ def rebuild_data():
             if not hist_r.empty:
                 rate = float(hist_r["Close"].iloc[-1])
             for s in symbols:
-                h = t.tickers[s].history(period="1d")
+                # ✅ 抓 5 天：最後一筆 = 市價，前一筆 = 前日收盤（算日漲跌）
+                h = t.tickers[s].history(period="5d")
                 prices[s] = float(h["Close"].iloc[-1]) if not h.empty else 0.0
+                if len(h) >= 2:
+                    prev_prices[s] = float(h["Close"].iloc[-2])
         except:
             pass
 
@@ -262,33 +303,16 @@ def rebuild_data():
     for s, d in inventory.items():
         if d["shares"] <= 0.001:
             continue
-        now_p = prices.get(s, 0.0)
-        m = get_mapping(s)
-        mv_org = d["shares"] * now_p
-        mv_twd = mv_org * (rate if d["currency"] == "USD" else 1.0)
-        total_stock_twd += mv_twd
-
-        holdings_rows.append({
-            "投資組合": m["組合"],
-            "代號": s,
-            "名稱": d["name"],
-            "資產類別": m["類別"],
-            "投資地區": m["地區"],
-            "幣別": d["currency"],
-            "持有股數": d["shares"],
-            "平均成本(原幣)": d["cost"] / d["shares"] if d["shares"] > 0 else 0.0,
-            "目前市價(原幣)": now_p,
-            "總成本(原幣)": d["cost"],
-            "總市值(原幣)": mv_org,
-            "未實現損益(原幣)": mv_org - d["cost"],
-            # ✅ 報酬率：直接存百分比數值（例如 12.34 = 12.34%）
-            "報酬率": ((mv_org - d["cost"]) / d["cost"] * 100.0) if d["cost"] > 0 else 0.0,
-            "匯率": rate if d["currency"] == "USD" else 1.0,
-            "總市值(TWD)": mv_twd,
-            "未實現損益(TWD)": (mv_org - d["cost"]) * (rate if d["currency"] == "USD" else 1.0),
-        })
+        h_row = make_holding_row(s, d, prices.get(s, 0.0), prev_prices.get(s, 0.0), rate)
+        total_stock_twd += h_row["總市值(TWD)"]
+        holdings_rows.append(h_row)
 
     df_h = pd.DataFrame(holdings_rows)
+
+    # ✅ 配息：依除息日持股算實領，併入持股表（含息報酬率）
+    df_div = build_dividend_ledger(df_l, rate)
+    df_h = attach_dividends(df_h, df_div)
+
     if not df_h.empty:
         conn.update(worksheet="holdings", data=df_h)
 
@@ -306,7 +330,889 @@ def rebuild_data():
         + total_stock_twd
     ) - s_dict.get("目前貸款金額(TWD)", 0.0)
 
-    return df_h, df_l, s_dict, nw, rate, symbols
+    return df_h, df_l, s_dict, nw, rate, symbols, df_div
+
+# ==========================================================
+# 3.1 風險分析引擎（日價格矩陣 + 增量統計）
+# ==========================================================
+RISK_BENCHMARKS = ["0050.TW", "VT"]
+RISK_HISTORY_PERIOD = "5y"
+TRADING_DAYS = 252
+RISK_MIN_OVERLAP = 20  # 兩檔同時有報酬的天數少於這個就不算共變異
+
+def _close_matrix(raw, tickers: list) -> pd.DataFrame:
+    # yf.download 單檔/多檔回傳格式不同，統一成「日期 x 代號」的收盤價矩陣
+    empty = pd.DataFrame(columns=tickers, index=pd.DatetimeIndex([]), dtype=float)
+    if raw is None or raw.empty or "Close" not in raw.columns.get_level_values(0):
+        return empty
+    close = raw["Close"]
+    if isinstance(close, pd.Series):
+        close = close.to_frame(tickers[0])
+    close = close.reindex(columns=tickers).astype(float)
+    idx = pd.to_datetime(close.index)
+    if idx.tz is not None:
+        idx = idx.tz_localize(None)
+    close.index = idx.normalize()
+    return close.groupby(level=0).last().sort_index()
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_daily_closes(tickers: tuple, start: str = "") -> pd.DataFrame:
+    # ✅ 一次批次抓所有代號；start 有值 = 只補抓新的交易日
+    kwargs = {"start": start} if start else {"period": RISK_HISTORY_PERIOD}
+    try:
+        raw = yf.download(list(tickers), interval="1d", auto_adjust=True, progress=False, **kwargs)
+    except:
+        raw = None
+    return _close_matrix(raw, list(tickers))
+
+def get_price_matrix(symbols: list) -> dict:
+    """
+    日收盤矩陣存在 session_state，之後只補抓「最後一天（含）之後」的資料。
+    今天的盤中價不進矩陣；最後一天每次都重抓覆蓋（伺服器時區比美股/BTC 早，
+    「昨天」的 K 棒可能還沒收），version 用來 memo 風險結果。
+    """
+    tickers = tuple(sorted(set(symbols) | set(RISK_BENCHMARKS))) + ("TWD=X",)
+    today = pd.Timestamp(datetime.now().date())
+    store = st.session_state.get("price_matrix")
+
+    if store is None or store["tickers"] != tickers or store["px"].empty:
+        px_all = fetch_daily_closes(tickers)
+        store = {"tickers": tickers, "px": px_all[px_all.index < today], "rev": 0,
+                 "base": None, "base_rows": 0, "base_fx": np.nan, "stats": None, "stats_version": None}
+    else:
+        last = store["px"].index[-1]
+        new = fetch_daily_closes(tickers, last.strftime("%Y-%m-%d"))
+        new = new[(new.index >= last) & (new.index < today)]
+        if not new.empty:
+            old_tail = store["px"].loc[[last]]
+            new = new.combine_first(old_tail)[store["px"].columns]  # 重抓缺值的欄位保留原值
+            if not new.equals(old_tail):
+                store["px"] = pd.concat([store["px"].iloc[:-1], new])
+                store["rev"] += 1
+
+    last_day = str(store["px"].index[-1].date()) if not store["px"].empty else ""
+    store["version"] = (tickers, len(store["px"]), last_day, store["rev"])
+    _advance_risk_stats(store)
+    st.session_state["price_matrix"] = store
+    return store
+
+def _twd_prices(block: pd.DataFrame, last_fx: float) -> pd.DataFrame:
+    # ✅ USD 計價的代號換成 TWD，風險都以台幣角度計算
+    fx = block["TWD=X"].ffill().fillna(last_fx).bfill()
+    px_twd = block.drop(columns=["TWD=X"])
+    usd_cols = [c for c in px_twd.columns if infer_currency(c) == "USD"]
+    px_twd[usd_cols] = px_twd[usd_cols].mul(fx, axis=0)
+    return px_twd
+
+def _new_risk_stats(k: int) -> dict:
+    return {
+        "n": np.zeros((k, k)),    # n[i, j]：i、j 同時有報酬的天數
+        "sx": np.zeros((k, k)),   # sx[i, j]：Σ r_i（只算 i、j 同時有效的日子）
+        "sxy": np.zeros((k, k)),  # sxy[i, j]：Σ r_i * r_j
+        "last_px": np.full(k, np.nan),  # 上一批最後的已知價格（跨批次算報酬用）
+        "peak": np.full(k, np.nan),     # 歷史高點
+        "mdd": np.zeros(k),             # 最大回撤（負值）
+        "dd_now": np.zeros(k),          # 目前回撤
+    }
+
+def _update_risk_stats(stats: dict, px: np.ndarray):
+    """px：新進的日收盤 (天數 x 代號數)，缺值為 NaN；只看新資料就能更新所有統計量"""
+    if px.shape[0] == 0:
+        return
+    filled = pd.DataFrame(np.vstack([stats["last_px"], px])).ffill().to_numpy()
+    prev, cur = filled[:-1], filled[1:]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = cur / prev - 1.0
+    valid = ~np.isnan(px) & ~np.isnan(prev) & (prev > 0)
+    x = np.where(valid, r, 0.0)
+    m = valid.astype(float)
+    stats["n"] += m.T @ m
+    stats["sx"] += x.T @ m
+    stats["sxy"] += x.T @ x
+    stats["last_px"] = filled[-1]
+
+    peak = np.fmax.accumulate(np.vstack([stats["peak"], cur]), axis=0)[1:]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dd = cur / peak - 1.0
+    stats["peak"] = peak[-1]
+    stats["mdd"] = np.fmin(stats["mdd"], np.fmin.reduce(dd, axis=0))
+    stats["dd_now"] = np.where(np.isnan(dd[-1]), stats["dd_now"], dd[-1])
+
+def _advance_risk_stats(store: dict):
+    # ✅ 最後一天可能被重抓覆蓋：base 只累積到倒數第二天（新日子進來才往前推），
+    # 最後一天每次從 base 複製一份再補上，不用整段重算
+    if store["stats_version"] == store["version"]:
+        return
+    px_all = store["px"]
+    settled = max(len(px_all) - 1, 0)
+    if store["base"] is None:
+        store["base"] = _new_risk_stats(px_all.shape[1] - 1)
+    block = px_all.iloc[store["base_rows"]:settled]
+    if not block.empty:
+        _update_risk_stats(store["base"], _twd_prices(block, store["base_fx"]).to_numpy(dtype=float))
+        store["base_rows"] = settled
+        fx_known = block["TWD=X"].dropna()
+        if not fx_known.empty:
+            store["base_fx"] = float(fx_known.iloc[-1])
+    stats = {k: v.copy() for k, v in store["base"].items()}
+    _update_risk_stats(stats, _twd_prices(px_all.iloc[settled:], store["base_fx"]).to_numpy(dtype=float))
+    store["stats"] = stats
+    store["stats_version"] = store["version"]
+
+def risk_covariance(stats: dict) -> np.ndarray:
+    # 兩兩重疊區間的樣本共變異（日報酬）
+    n, sx, sxy = stats["n"], stats["sx"], stats["sxy"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = (sxy - sx * sx.T / n) / (n - 1)
+    cov[n < RISK_MIN_OVERLAP] = np.nan
+    return cov
+
+def compute_risk_report(store: dict, weights: pd.Series) -> dict:
+    """weights：代號 -> 市值(TWD)。結果依 (價格矩陣版本, 權重) memo，沒有新日子就不重算"""
+    # ✅ key 用正規化後的權重取到 1e-4：即時報價（BTC 24 小時在跳）每次重跑都會變，市值當 key 等於沒 memo
+    total = float(weights.sum())
+    w_key = tuple((k, round(float(v) / total, 4) if total > 0 else 0.0) for k, v in weights.sort_index().items())
+    key = (store["version"], w_key)
+    memo = st.session_state.get("risk_memo")
+    if memo is not None and memo[0] == key:
+        return memo[1]
+
+    cols = [c for c in store["tickers"] if c != "TWD=X"]
+    stats = store["stats"]
+    cov = risk_covariance(stats)
+    var = np.diag(cov)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corr = cov / np.sqrt(np.outer(var, var))
+
+    per = pd.DataFrame({
+        "年化波動(%)": np.sqrt(var * TRADING_DAYS) * 100.0,
+        "最大回撤(%)": stats["mdd"] * 100.0,
+        "目前回撤(%)": stats["dd_now"] * 100.0,
+    }, index=cols)
+    for b in RISK_BENCHMARKS:
+        j = cols.index(b)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            per[f"Beta({b})"] = cov[:, j] / cov[j, j]
+
+    w = weights.reindex(cols).fillna(0.0).to_numpy(dtype=float)
+    w = w / w.sum() if w.sum() > 0 else w
+    held = w > 0
+
+    # 組合：以目前權重固定配置，回推歷史日報酬（整段一次向量化）
+    px_twd = _twd_prices(store["px"], np.nan).to_numpy(dtype=float)
+    filled = pd.DataFrame(px_twd).ffill().to_numpy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = filled[1:] / filled[:-1] - 1.0
+    r = np.where(np.isnan(px_twd[1:]) | np.isnan(r), 0.0, r)
+    nav_p = np.cumprod(1.0 + r @ w) if len(r) else np.array([1.0])
+    port_mdd = float(np.min(nav_p / np.maximum.accumulate(nav_p) - 1.0)) if len(nav_p) else 0.0
+
+    cov0 = np.nan_to_num(cov)
+    port = {
+        "年化波動(%)": float(np.sqrt(max(w @ cov0 @ w, 0.0) * TRADING_DAYS) * 100.0),
+        "最大回撤(%)": port_mdd * 100.0,
+    }
+    for b in RISK_BENCHMARKS:
+        port[f"Beta({b})"] = float(np.nansum(per[f"Beta({b})"].to_numpy() * w))
+
+    show = [c for c, h in zip(cols, held) if h] + [b for b in RISK_BENCHMARKS if not held[cols.index(b)]]
+    idx = [cols.index(c) for c in show]
+    report = {
+        "per": per.loc[[c for c, h in zip(cols, held) if h]].assign(**{"權重(%)": w[held] * 100.0}),
+        "portfolio": port,
+        "corr": pd.DataFrame(corr[np.ix_(idx, idx)], index=show, columns=show),
+        "days": int(stats["n"].diagonal().max()) if len(cols) else 0,
+        "start": str(store["px"].index[0].date()) if not store["px"].empty else "",
+        "end": store["version"][2],
+    }
+    st.session_state["risk_memo"] = (key, report)
+    return report
+
+# ==========================================================
+# 3.2 再平衡計算（依投資組合目標權重）
+# ==========================================================
+TW_FEE_RATE = 0.001425      # 台股手續費（未打折）
+TW_FEE_MIN_TWD = 20.0
+US_FEE_RATE = 0.001         # 複委託/美股券商，概抓
+TW_TAX_STOCK = 0.003        # 個股證交稅
+TW_TAX_ETF = 0.001          # ETF 證交稅（債券 ETF 免）
+
+def lot_size(sym: str, tw_board_lot: bool = False) -> float:
+    if sym.endswith("-USD"):
+        return 0.0001
+    if sym.endswith(".TW") or sym.endswith(".TWO"):
+        return 1000.0 if tw_board_lot else 1.0  # 整張 / 零股
+    return 1.0
+
+def trade_cost_rates(sym: str):
+    """回傳 (手續費率, 最低手續費TWD, 賣出稅率)"""
+    if infer_currency(sym) == "TWD":
+        if sym in TAIWAN_BOND_SYMBOLS:
+            tax = 0.0
+        elif sym.startswith("00"):
+            tax = TW_TAX_ETF
+        else:
+            tax = TW_TAX_STOCK
+        return TW_FEE_RATE, TW_FEE_MIN_TWD, tax
+    return US_FEE_RATE, 0.0, 0.0
+
+def build_rebalance_lines(df_h: pd.DataFrame, tw_board_lot: bool = False) -> pd.DataFrame:
+    # ✅ 每一檔持股一列：組合內依市值比例分攤該組合的買賣，賣出不會超過持有股數
+    if df_h is None or df_h.empty:
+        return pd.DataFrame()
+    lines = df_h[["投資組合", "代號", "持有股數", "總市值(TWD)"]].rename(columns={"總市值(TWD)": "目前市值(TWD)"})
+    lines["價格(TWD)"] = df_h["目前市價(原幣)"] * df_h["匯率"]
+    lines["單位"] = [lot_size(s, tw_board_lot) for s in lines["代號"]]
+    costs = [trade_cost_rates(s) for s in lines["代號"]]
+    lines["手續費率"] = [c[0] for c in costs]
+    lines["最低手續費"] = [c[1] for c in costs]
+    lines["賣出稅率"] = [c[2] for c in costs]
+    grp_mv = lines.groupby("投資組合")["目前市值(TWD)"].transform("sum")
+    lines = lines.assign(_grp_mv=grp_mv).sort_values(["_grp_mv", "目前市值(TWD)"], ascending=False)
+    return lines.drop(columns="_grp_mv").reset_index(drop=True)
+
+def rebalance_groups(lines: pd.DataFrame) -> pd.Series:
+    # 組合目前市值（依市值大到小，順序跟 lines 一致）
+    return lines.groupby("投資組合", sort=False)["目前市值(TWD)"].sum()
+
+def rebalance_batch(lines: pd.DataFrame, targets: np.ndarray, cash_twd: float,
+                    reserve_twd: float, contributions: np.ndarray) -> dict:
+    """
+    一次算 S 個情境（每個加碼金額一列） x H 檔持股的交易。
+    targets：各組合目標權重（合計 1，順序同 rebalance_groups）；組合內依目前市值比例分配。
+    reserve_twd：不參與配置的金額（例如預留還款）。
+    """
+    groups = rebalance_groups(lines)
+    g_idx = pd.Index(groups.index).get_indexer(lines["投資組合"])
+    onehot = np.zeros((len(lines), len(groups)))
+    onehot[np.arange(len(lines)), g_idx] = 1.0
+
+    cur = lines["目前市值(TWD)"].to_numpy(dtype=float)
+    held = lines["持有股數"].to_numpy(dtype=float)
+    px_twd = lines["價格(TWD)"].to_numpy(dtype=float)
+    lots = lines["單位"].to_numpy(dtype=float)
+    fee_rate = lines["手續費率"].to_numpy(dtype=float)
+    fee_min = lines["最低手續費"].to_numpy(dtype=float)
+    tax_rate = lines["賣出稅率"].to_numpy(dtype=float)
+
+    # 組合目標 → 個股目標：依組合內市值占比（組合市值為 0 時平均分）
+    grp_mv = groups.to_numpy(dtype=float)[g_idx]
+    grp_n = onehot.sum(axis=0)[g_idx]
+    within = np.where(grp_mv > 0, cur / np.where(grp_mv > 0, grp_mv, 1.0), 1.0 / grp_n)
+    line_t = targets[g_idx] * within
+
+    contrib = np.asarray(contributions, dtype=float)[:, None]        # (S, 1)
+    investable = cur.sum() + cash_twd - reserve_twd + contrib        # (S, 1)
+    delta = line_t[None, :] * investable - cur[None, :]              # (S, H)
+
+    ok = px_twd > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        units = np.where(ok, np.fix(delta / np.where(ok, px_twd, 1.0) / lots), 0.0)
+    shares = np.maximum(units * lots, -held)                         # 賣出上限 = 持有股數
+    notional = shares * px_twd
+    gross = np.abs(notional)
+    fees = np.where(shares != 0, np.maximum(gross * fee_rate, fee_min), 0.0)
+    taxes = np.where(shares < 0, gross * tax_rate, 0.0)
+
+    post_g = (cur[None, :] + notional) @ onehot                      # (S, G)
+    cash_after = cash_twd + contrib[:, 0] - notional.sum(axis=1) - fees.sum(axis=1) - taxes.sum(axis=1)
+    total_after = post_g.sum(axis=1) + cash_after
+    with np.errstate(divide="ignore", invalid="ignore"):
+        post_w = post_g / post_g.sum(axis=1, keepdims=True)
+    return {
+        "shares": shares,
+        "notional": notional,
+        "fees": fees + taxes,
+        "group_notional": notional @ onehot,
+        "cash_after": cash_after,
+        "total_after": total_after,
+        "post_weights": post_w,
+        "max_drift": np.fmax.reduce(np.abs(post_w - targets[None, :]), axis=1),
+    }
+
+# ==========================================================
+# 3.3 淨值蒙地卡羅模擬（含貸款槓桿）
+# ==========================================================
+MONTH_DAYS = 21
+MC_MAX_REPORT_POINTS = 121 # 百分位只記錄這麼多個時間點
+MC_PERCENTILES = [5, 25, 50, 75, 95]
+
+def holding_return_params(store: dict, weights: pd.Series):
+    """從風險引擎的增量統計量取出持股的月報酬參數 (對數報酬 mu, cov) 與權重"""
+    cols = [c for c in store["tickers"] if c != "TWD=X"]
+    w = weights.reindex(cols).fillna(0.0)
+    held = [i for i, c in enumerate(cols) if w.iloc[i] > 0]
+    stats = store["stats"]
+    ix = np.ix_(held, held)
+
+    n = stats["n"].diagonal()[held]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mu_d = stats["sx"].diagonal()[held] / n
+    cov_d = risk_covariance(stats)[ix]
+
+    # 資料不足的代號：變異數用其他持股的中位數、相關係數當 0
+    var = np.diag(cov_d).copy()
+    fallback = np.nanmedian(var) if np.isfinite(var).any() else (0.02 ** 2)
+    bad = ~np.isfinite(var)
+    var[bad] = fallback
+    cov_d = np.nan_to_num(cov_d)
+    np.fill_diagonal(cov_d, var)
+    mu_d = np.where(np.isfinite(mu_d), mu_d, 0.0)
+
+    # 半正定投影留給 simulate_net_worth：呼叫端會先取整當快取 key，取整後再投影才不會變回不定
+    mu_m = MONTH_DAYS * (mu_d - var / 2.0)
+    cov_m = MONTH_DAYS * cov_d
+    w_held = w.iloc[held].to_numpy(dtype=float)
+    return [cols[i] for i in held], mu_m, cov_m, w_held / w_held.sum()
+
+@st.cache_data(persist="disk", max_entries=16, show_spinner=False)
+def simulate_net_worth(mu_m: np.ndarray, cov_m: np.ndarray, weights: np.ndarray,
+                       assets0: float, cash0: float, loan0: float, loan_rate: float,
+                       monthly_contrib: float, monthly_repay: float, months: int,
+                       n_paths: int, ltv_limit: float, seed: int = 2026) -> dict:
+    """
+    每月：資產 x (1 + 組合報酬) + (定期投入 - 貸款利息 - 還本)；貸款餘額每月減還本。
+    淨值 = 證券 + 現金 - 貸款；LTV = 貸款 / 證券市值。
+    報酬逐月抽（一次 路徑數 x 資產數），只保留報表時間點的淨值，
+    記憶體 ≈ 路徑數 x (資產數 + 報表點數)，跟模擬年數無關。
+    參數相同時直接吃 st.cache_data（persist 到磁碟），重開頁面不用重算。
+    cov_m 可以不是半正定（兩兩重疊區間算的），這裡才投影。
+    """
+    k = len(weights)
+    # ✅ 特徵值截到 trace 的相對下限再分解，取整或重疊區間造成的負特徵值都不會讓 cholesky 失敗
+    eig, vec = np.linalg.eigh((cov_m + cov_m.T) / 2.0)
+    floor = max(1e-10 * float(np.trace(cov_m)) / max(k, 1), 1e-16)
+    chol = np.linalg.cholesky((vec * np.clip(eig, floor, None)) @ vec.T)
+
+    # 貸款與利息路徑跟市場無關，先算好
+    loan = np.empty(months + 1)
+    loan[0] = loan0
+    interest = np.empty(months)
+    for t in range(months):
+        interest[t] = loan[t] * loan_rate / 12.0
+        loan[t + 1] = max(loan[t] - monthly_repay, 0.0)
+    flow = monthly_contrib - interest - (loan[:-1] - loan[1:])
+
+    step = max(1, int(np.ceil(months / (MC_MAX_REPORT_POINTS - 1))))
+    report_t = np.unique(np.append(np.arange(0, months + 1, step), months))
+    nw_pts = np.empty((n_paths, len(report_t)), dtype=np.float32)
+    first_breach = np.full(n_paths, -1, dtype=np.int32)
+
+    rng = np.random.default_rng(seed)
+    a = np.full(n_paths, assets0, dtype=float)
+    j = 0
+    if report_t[0] == 0:
+        nw_pts[:, 0] = a + cash0 - loan[0]
+        j = 1
+    for t in range(months):
+        z = rng.standard_normal((n_paths, k))
+        r_p = np.expm1(z @ chol.T + mu_m) @ weights
+        a = np.maximum(a * (1.0 + r_p) + flow[t], 0.0)
+        if loan[t + 1] > 0:
+            with np.errstate(divide="ignore"):
+                hit = (loan[t + 1] / a >= ltv_limit) & (first_breach < 0)
+            first_breach[hit] = t + 1
+        if j < len(report_t) and report_t[j] == t + 1:
+            nw_pts[:, j] = a + cash0 - loan[t + 1]
+            j += 1
+
+    bands = pd.DataFrame(
+        np.percentile(nw_pts, MC_PERCENTILES, axis=0).T,
+        index=report_t, columns=[f"P{p}" for p in MC_PERCENTILES]
+    )
+    breached = first_breach[first_breach > 0]
+    breach_curve = np.cumsum(np.bincount(breached, minlength=months + 1))[report_t] / n_paths
+    return {
+        "bands": bands,
+        "breach_prob": float((first_breach > 0).mean()),
+        "breach_curve": pd.Series(breach_curve, index=report_t),
+        "loan": pd.Series(loan[report_t], index=report_t),
+        "terminal_mean": float(nw_pts[:, -1].mean()),
+    }
+
+# ==========================================================
+# 3.4 配息紀錄（批次抓除息資料 + 依除息日持股計算）
+# ==========================================================
+DIVIDEND_WITHHOLDING = {"USD": 0.30}  # 美股配息預扣 30%；台股以實領計
+
+DIVIDEND_COLS = ["除息日", "代號", "幣別", "每股配息", "持有股數", "配息(原幣)", "預扣稅(原幣)", "實領(原幣)", "實領(TWD)"]
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def fetch_dividend_history(tickers: tuple, start: str) -> pd.DataFrame:
+    # ✅ 所有代號一次批次抓（actions=True 會帶 Dividends 欄），一天更新一次
+    empty = pd.DataFrame(columns=["代號", "除息日", "每股配息"])
+    try:
+        raw = yf.download(list(tickers), start=start, interval="1d", actions=True,
+                          auto_adjust=False, progress=False)
+    except:
+        return empty
+    if raw is None or raw.empty or "Dividends" not in raw.columns.get_level_values(0):
+        return empty
+
+    div = raw["Dividends"]
+    if isinstance(div, pd.Series):
+        div = div.to_frame(tickers[0])
+    idx = pd.to_datetime(div.index)
+    if idx.tz is not None:
+        idx = idx.tz_localize(None)
+    div.index = idx.normalize()
+    div.index.name = "除息日"
+    long = div.stack().rename("每股配息").reset_index()
+    long.columns = ["除息日", "代號", "每股配息"]
+    long = long[long["每股配息"] > 0]
+    return long[["代號", "除息日", "每股配息"]].reset_index(drop=True)
+
+def share_ledger(df_l: pd.DataFrame) -> pd.DataFrame:
+    # ✅ 每筆交易後的累積持股（向量化）：代號 / 日期 / 持股
+    if df_l is None or df_l.empty or "股票代號" not in df_l.columns:
+        return pd.DataFrame(columns=["代號", "日期", "持股"])
+
+    def num(col):
+        if col not in df_l.columns:
+            return pd.Series(0.0, index=df_l.index)
+        return pd.to_numeric(df_l[col].astype(str).str.replace(",", ""), errors="coerce").fillna(0.0)
+
+    led = pd.DataFrame({
+        "代號": df_l["股票代號"].fillna("").astype(str).str.strip().map(normalize_symbol),
+        "日期": pd.to_datetime(df_l["日期"], errors="coerce"),
+        "變動": num("買入股數") - num("賣出股數"),
+    })
+    led = led[(led["代號"] != "") & (led["代號"] != "NAN") & led["日期"].notna()]
+    led = led.sort_values("日期", kind="stable")
+    led["持股"] = led.groupby("代號")["變動"].cumsum().clip(lower=0.0)
+    return led[["代號", "日期", "持股"]]
+
+def build_dividend_ledger(df_l: pd.DataFrame, rate: float) -> pd.DataFrame:
+    """每筆除息 x 除息日前一刻的持股（除息日當天買進不配）"""
+    led = share_ledger(df_l)
+    if led.empty:
+        return pd.DataFrame(columns=DIVIDEND_COLS)
+
+    start = (led["日期"].min() - pd.Timedelta(days=7)).strftime("%Y-%m-%d")
+    divs = fetch_dividend_history(tuple(sorted(led["代號"].unique())), start)
+    if divs.empty:
+        return pd.DataFrame(columns=DIVIDEND_COLS)
+
+    df = pd.merge_asof(
+        divs.sort_values("除息日"), led.sort_values("日期"),
+        left_on="除息日", right_on="日期", by="代號", allow_exact_matches=False
+    )
+    df["持有股數"] = df["持股"].fillna(0.0)
+    df = df[df["持有股數"] > 0.001].copy()
+
+    df["幣別"] = df["代號"].map(infer_currency)
+    df["配息(原幣)"] = df["每股配息"] * df["持有股數"]
+    df["預扣稅(原幣)"] = df["配息(原幣)"] * df["幣別"].map(DIVIDEND_WITHHOLDING).fillna(0.0)
+    df["實領(原幣)"] = df["配息(原幣)"] - df["預扣稅(原幣)"]
+    df["實領(TWD)"] = df["實領(原幣)"] * np.where(df["幣別"] == "USD", rate, 1.0)
+    return df[DIVIDEND_COLS].sort_values("除息日", ascending=False).reset_index(drop=True)
+
+def attach_dividends(df_h: pd.DataFrame, df_div: pd.DataFrame) -> pd.DataFrame:
+    # ✅ 持股表加上累計配息與含息報酬率
+    if df_h is None or df_h.empty:
+        return df_h
+    paid = df_div.groupby("代號")["實領(原幣)"].sum() if not df_div.empty else pd.Series(dtype=float)
+    df_h = df_h.copy()
+    df_h["累計配息(原幣)"] = df_h["代號"].map(paid).fillna(0.0)
+    df_h["累計配息(TWD)"] = df_h["累計配息(原幣)"] * df_h["匯率"]
+    cost = df_h["總成本(原幣)"]
+    df_h["含息報酬率"] = np.where(
+        cost > 0, (df_h["未實現損益(原幣)"] + df_h["累計配息(原幣)"]) / cost.where(cost > 0, 1.0) * 100.0, 0.0
+    )
+    return df_h
+
+# ==========================================================
+# 3.5 績效彙總表（增量維護，報表不再重掃 trade_logs）
+# ==========================================================
+ROLLUP_KEYS = ["月份", "代號", "幣別", "平台", "帳戶類型", "快照後"]
+ROLLUP_VALUES = ["買入金額", "賣出金額", "成交金額", "淨現金流", "已實現損益", "已實現成本", "筆數"]
+
+def _num_col(df: pd.DataFrame, col: str) -> pd.Series:
+    if col not in df.columns:
+        return pd.Series(0.0, index=df.index)
+    return pd.to_numeric(df[col].astype(str).str.replace(",", ""), errors="coerce").fillna(0.0).astype(float)
+
+def _str_col(df: pd.DataFrame, col: str) -> pd.Series:
+    if col not in df.columns:
+        return pd.Series("", index=df.index)
+    s = df[col].fillna("").astype(str).str.strip()
+    return s.where(~s.str.lower().isin(["nan", "none"]), "")
+
+def _rollup_rows(df: pd.DataFrame, baseline_ts: datetime) -> pd.DataFrame:
+    """把一段 trade_logs（只看買入/賣出）向量化聚合成彙總表；金額皆為原幣，顯示時才換匯"""
+    if df is None or df.empty or "交易類型" not in df.columns:
+        return pd.DataFrame(columns=ROLLUP_KEYS + ROLLUP_VALUES)
+    df = df[_str_col(df, "交易類型").isin(["買入", "賣出"])]
+    if df.empty:
+        return pd.DataFrame(columns=ROLLUP_KEYS + ROLLUP_VALUES)
+
+    sym = _str_col(df, "股票代號").map(normalize_symbol)
+    cur = _str_col(df, "幣別").str.upper()
+    cur = cur.where(cur != "", sym.map(infer_currency))
+    is_sell = _str_col(df, "交易類型").eq("賣出")
+
+    net = _num_col(df, "應收付(原幣)")
+    cost = _num_col(df, "成本(原幣)※賣出需填")
+    profit = _num_col(df, "損益(原幣)")
+    profit = profit.where(profit != 0.0, net - cost)
+    gross = _num_col(df, "價金(原幣)").abs()
+
+    created = pd.to_datetime(_str_col(df, "建立時間"), format="%Y-%m-%d %H:%M:%S", errors="coerce")
+    month = pd.to_datetime(_str_col(df, "日期"), errors="coerce").dt.strftime("%Y-%m").fillna("未知")
+
+    rows = pd.DataFrame({
+        "月份": month,
+        "代號": sym,
+        "幣別": cur,
+        "平台": _str_col(df, "平台"),
+        "帳戶類型": _str_col(df, "帳戶類型"),
+        "快照後": (created > pd.Timestamp(baseline_ts)).fillna(False),
+        "買入金額": net.where(~is_sell, 0.0),
+        "賣出金額": net.where(is_sell, 0.0),
+        "成交金額": gross.where(gross > 0, net.abs()),
+        "淨現金流": net.where(is_sell, -net),
+        "已實現損益": profit.where(is_sell, 0.0),
+        "已實現成本": cost.where(is_sell, 0.0),
+        "筆數": 1,
+    })
+    return rows.groupby(ROLLUP_KEYS, as_index=False)[ROLLUP_VALUES].sum()
+
+def _rows_fingerprint(df: pd.DataFrame, rows: int) -> tuple:
+    # 已處理列的向量化雜湊：Sheet 裡任何一列被改都會讓它變
+    head = df.iloc[:rows]
+    return tuple(head.columns), int(pd.util.hash_pandas_object(head, index=False).sum())
+
+def get_trade_rollup(df_l: pd.DataFrame, baseline_ts: datetime) -> pd.DataFrame:
+    """
+    彙總表放在 session_state，trade_logs 是 append-only：
+    已處理的列（用雜湊比對）沒變，就只聚合後面新增的列再併進去；
+    筆數變少、任何已處理列被改或 baseline 變了才整張重建。
+    """
+    n = 0 if df_l is None else len(df_l)
+    state = st.session_state.get("trade_rollup")
+    valid = (
+        state is not None
+        and state["baseline"] == baseline_ts
+        and state["rows"] <= n
+        and (state["rows"] == 0 or _rows_fingerprint(df_l, state["rows"]) == state["fp"])
+    )
+    if not valid:
+        state = {"rows": 0, "fp": None, "baseline": baseline_ts, "table": _rollup_rows(None, baseline_ts)}
+
+    if n > state["rows"]:
+        part = _rollup_rows(df_l.iloc[state["rows"]:], baseline_ts)
+        if not part.empty:
+            table = part if state["table"].empty else pd.concat([state["table"], part], ignore_index=True)
+            state["table"] = table.groupby(ROLLUP_KEYS, as_index=False)[ROLLUP_VALUES].sum()
+        state["rows"] = n
+        state["fp"] = _rows_fingerprint(df_l, n)
+
+    st.session_state["trade_rollup"] = state
+    return state["table"]
+
+def rollup_report(rollup: pd.DataFrame, by: list, rate: float) -> pd.DataFrame:
+    # ✅ 報表：從彙總表再 group（彙總表很小），這時才依目前匯率換 TWD
+    if rollup is None or rollup.empty:
+        return pd.DataFrame(columns=by + ["買入(TWD)", "賣出(TWD)", "成交金額(TWD)", "淨現金流(TWD)", "已實現損益(TWD)", "ROI(%)", "筆數"])
+    df = rollup.copy()
+    df["年度"] = df["月份"].str[:4]
+    fx = np.where(df["幣別"] == "USD", rate, 1.0)
+    out = pd.DataFrame({
+        **{k: df[k] for k in by},
+        "買入(TWD)": df["買入金額"] * fx,
+        "賣出(TWD)": df["賣出金額"] * fx,
+        "成交金額(TWD)": df["成交金額"] * fx,
+        "淨現金流(TWD)": df["淨現金流"] * fx,
+        "已實現損益(TWD)": df["已實現損益"] * fx,
+        "已實現成本(TWD)": df["已實現成本"] * fx,
+        "筆數": df["筆數"],
+    }).groupby(by, as_index=False).sum()
+    cost = out.pop("已實現成本(TWD)")
+    out.insert(len(by) + 5, "ROI(%)", np.where(cost > 0, out["已實現損益(TWD)"] / cost.where(cost > 0, 1.0) * 100.0, 0.0))
+    return out.sort_values(by, ascending=[k in ("代號", "平台", "帳戶類型") for k in by]).reset_index(drop=True)
+
+# ==========================================================
+# 3.6 警示引擎（每次更新市價時向量化評估）
+# ==========================================================
+ALERT_TYPES = ["價格高於", "價格低於", "日漲跌超過(%)", "配置偏離超過(%)", "淨值低於", "LTV高於(%)"]
+ALERT_RULE_COLS = ["啟用", "類型", "目標", "門檻", "目標權重(%)", "冷卻(分鐘)", "備註"]
+ALERT_LOG_PATH = os.path.join("data", "alert_history.csv")
+ALERT_LOG_COLS = ["時間", "規則", "類型", "目標", "數值", "門檻", "訊息"]
+
+# ✅ 可插拔的通知出口：收到一批觸發的警示 (DataFrame)，自己決定怎麼送
+ALERT_SINKS = []
+
+def alert_sink(fn):
+    ALERT_SINKS.append(fn)
+    return fn
+
+@alert_sink
+def _toast_sink(fired: pd.DataFrame):
+    for msg in fired["訊息"]:
+        st.toast(f"🔔 {msg}")
+
+@alert_sink
+def _csv_sink(fired: pd.DataFrame):
+    # 本機 CSV 同時當作警示歷史
+    os.makedirs(os.path.dirname(ALERT_LOG_PATH), exist_ok=True)
+    new_file = not os.path.exists(ALERT_LOG_PATH)
+    fired[ALERT_LOG_COLS].to_csv(ALERT_LOG_PATH, mode="a", header=new_file, index=False, encoding="utf-8-sig")
+
+@st.cache_resource
+def _alert_state() -> dict:
+    # 跨 session 共用：避免多個分頁同時開著時重複發送
+    return {"lock": threading.Lock(), "active": {}, "last": {}}
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _read_alert_rules_sheet() -> pd.DataFrame:
+    # 規則自己一份快取：存檔時只清這個，不動價格/配息/模擬的快取
+    # 第一次存檔前還沒有 alert_rules 分頁：回傳空表，讓「沒有分頁」也吃到 TTL，不會每次重跑都打 API
+    try:
+        return conn.read(worksheet="alert_rules", ttl=0)
+    except WorksheetNotFound:
+        return pd.DataFrame(columns=ALERT_RULE_COLS)
+
+def load_alert_rules() -> pd.DataFrame:
+    try:
+        df = _read_alert_rules_sheet()
+    except:
+        df = None
+    if df is None or df.empty:
+        return pd.DataFrame(columns=ALERT_RULE_COLS)
+    for c in ALERT_RULE_COLS:
+        if c not in df.columns:
+            df[c] = ""
+    df = df[ALERT_RULE_COLS].dropna(how="all").reset_index(drop=True)
+    # 整欄空白會讀成 float NaN，data_editor 會當數字欄而不能輸入代號/組合名稱
+    for c in ["目標", "備註"]:
+        df[c] = df[c].fillna("").astype(str)
+    return df
+
+def save_alert_rules(rules: pd.DataFrame):
+    # 新的試算表還沒有 alert_rules 分頁：update 失敗就改用 create 建立
+    data = rules[ALERT_RULE_COLS]
+    try:
+        conn.update(worksheet="alert_rules", data=data)
+    except:
+        conn.create(worksheet="alert_rules", data=data)
+    _read_alert_rules_sheet.clear()
+
+def evaluate_alert_rules(rules: pd.DataFrame, df_h: pd.DataFrame, net_worth: float, ltv_pct: float) -> pd.DataFrame:
+    """所有規則一次向量化算出目前數值與是否成立（不處理去重/冷卻）"""
+    out = rules.copy()
+    if out.empty:
+        return out.assign(規則=[], 數值=[], 成立=[])
+
+    typ = out["類型"].fillna("").astype(str).str.strip()
+    target = out["目標"].fillna("").astype(str).str.strip()
+    thr = pd.to_numeric(out["門檻"], errors="coerce")
+    tgt_w = pd.to_numeric(out["目標權重(%)"], errors="coerce")
+    enabled = out["啟用"].map(lambda v: str(v).strip().lower() in ("true", "1", "y", "yes", "是"))
+
+    if df_h is not None and not df_h.empty:
+        by_sym = df_h.groupby("代號")
+        price = by_sym["目前市價(原幣)"].first()
+        move = by_sym["日漲跌(%)"].first() if "日漲跌(%)" in df_h.columns else pd.Series(dtype=float)
+        alloc = df_h.groupby("投資組合")["總市值(TWD)"].sum()
+        alloc = alloc / alloc.sum() * 100.0 if alloc.sum() > 0 else alloc
+    else:
+        price = move = alloc = pd.Series(dtype=float)
+
+    sym = target.map(normalize_symbol)
+    value = np.select(
+        [typ.isin(["價格高於", "價格低於"]), typ.eq("日漲跌超過(%)"), typ.eq("配置偏離超過(%)"),
+         typ.eq("淨值低於"), typ.eq("LTV高於(%)")],
+        [sym.map(price), sym.map(move).abs(), (target.map(alloc) - tgt_w).abs(),
+         net_worth, ltv_pct],
+        default=np.nan
+    ).astype(float)
+    below = typ.isin(["價格低於", "淨值低於"]).to_numpy()
+    hit = np.where(below, value <= thr.to_numpy(), value >= thr.to_numpy())
+
+    out["類型"] = typ
+    out["目標"] = target  # 空白儲存格讀回來是 NaN，這裡統一成 ""
+    out["規則"] = typ + "|" + target + "|" + thr.map("{:g}".format)
+    out["數值"] = value
+    out["成立"] = hit & enabled.to_numpy() & ~np.isnan(value) & thr.notna().to_numpy()
+    return out
+
+def run_alerts(df_h: pd.DataFrame, net_worth: float, ltv_pct: float) -> pd.DataFrame:
+    """評估 + 去重（只在由不成立→成立時發）+ 冷卻時間，發出的交給所有 sink"""
+    rules = load_alert_rules()
+    ev = evaluate_alert_rules(rules, df_h, net_worth, ltv_pct)
+    if ev.empty:
+        return ev
+
+    state = _alert_state()
+    now = datetime.now()
+    cooldown = pd.to_numeric(ev["冷卻(分鐘)"], errors="coerce").fillna(60.0).to_numpy()
+    with state["lock"]:
+        was_active = ev["規則"].map(state["active"]).fillna(False).astype(bool).to_numpy()
+        last = pd.to_datetime(ev["規則"].map(state["last"]))
+        since = ((pd.Timestamp(now) - last).dt.total_seconds() / 60.0).fillna(np.inf).to_numpy()
+        fire = ev["成立"].to_numpy() & ~was_active & (since >= cooldown)
+        state["active"].update(dict(zip(ev["規則"], ev["成立"])))
+        state["last"].update({k: now for k in ev.loc[fire, "規則"]})
+
+    fired = ev[fire].copy()
+    if not fired.empty:
+        fired["時間"] = now.strftime("%Y-%m-%d %H:%M:%S")
+        fired["訊息"] = [
+            f"{' '.join(x for x in [r['類型'], r['目標']] if x)}：目前 {r['數值']:,.2f}（門檻 {float(r['門檻']):,.2f}）"
+            for _, r in fired.iterrows()
+        ]
+        for sink in ALERT_SINKS:
+            try:
+                sink(fired)
+            except:
+                pass
+    return ev
+
+def read_alert_history(limit: int = 200) -> pd.DataFrame:
+    if not os.path.exists(ALERT_LOG_PATH):
+        return pd.DataFrame(columns=ALERT_LOG_COLS)
+    try:
+        return pd.read_csv(ALERT_LOG_PATH, encoding="utf-8-sig").tail(limit).iloc[::-1]
+    except:
+        return pd.DataFrame(columns=ALERT_LOG_COLS)
+
+# ==========================================================
+# 3.7 交易寫入（筆數版本檢查 + 冪等鍵 + 增量更新持股）
+# ==========================================================
+TRADE_WRITE_RETRIES = 3
+DIVIDEND_HOLDING_COLS = ["累計配息(原幣)", "累計配息(TWD)", "含息報酬率"]
+
+@st.cache_resource
+def _trade_write_lock():
+    # 同一台 server 上的 session 排隊：先查冪等鍵再 append，避免連點寫兩筆
+    return threading.Lock()
+
+def trade_idempotency_key(row: dict, draft_id: str) -> str:
+    # 表單內容 + 草稿 ID → 同一張單重送（連點、重試）會得到同一把 key
+    # 市值(新台幣) 跟著即時匯率變、建立時間是送出當下才蓋，都不算進 key
+    fields = {k: str(v) for k, v in sorted(row.items()) if k not in ("交易ID", "市值(新台幣)", "建立時間")}
+    payload = json.dumps({"draft": draft_id, **fields}, ensure_ascii=False)
+    # 加 T 開頭：純數字（或像 1e5）的 hex 會被 Sheets 存成數字，讀回來就比對不到
+    return "T" + hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+def _trade_ids(df: pd.DataFrame) -> set:
+    if df is None or "交易ID" not in df.columns:
+        return set()
+    return set(df["交易ID"].fillna("").astype(str))
+
+def _sheet_cell(v):
+    # gspread append 只吃原生型別；NaN 寫成空白
+    if v is None:
+        return ""
+    if isinstance(v, (float, np.floating)):
+        return "" if np.isnan(v) else float(v)
+    if isinstance(v, np.integer):
+        return int(v)
+    return v
+
+def _worksheet_selector():
+    # ⚠️ 依賴 st-gsheets-connection 的私有方法 _select_worksheet（回傳 gspread Worksheet）；
+    # 套件升級拿掉它時直接報清楚的錯，不要默默退回整張重寫
+    select = getattr(getattr(conn, "client", None), "_select_worksheet", None)
+    if select is None:
+        raise RuntimeError("目前的 st-gsheets-connection 版本沒有 _select_worksheet，無法逐筆 append 交易，請確認套件版本")
+    return select
+
+def _append_trade_row(ws, header: list, row: dict):
+    """只 append 一列（Sheets 端原子操作），不重寫整張 trade_logs，別人的新交易不會被蓋掉"""
+    header = list(header)
+    missing = [c for c in TRADELOG_COLS if c not in header]
+    if missing:
+        if ws.col_count < len(header) + len(missing):
+            ws.add_cols(len(header) + len(missing) - ws.col_count)
+        for c in missing:
+            header.append(c)
+            ws.update_cell(1, len(header), c)
+    ws.append_rows([[_sheet_cell(row.get(c, "")) for c in header]],
+                   value_input_option="USER_ENTERED", table_range="A1")
+
+def commit_trade(row: dict, expected_rows: int):
+    """
+    回傳 (狀態, 寫入後的 trade_logs)；狀態：committed / merged / duplicate。
+    expected_rows 是本次 rerun 讀到的筆數：不一致代表別人先寫了（append 會自然接在最新資料後面）。
+    寫入用 append（不重寫整張），寫完再讀一次確認自己那筆在，失敗就重試。
+    """
+    key = row["交易ID"]
+    status = "committed"
+    last_err = None
+    select = _worksheet_selector()
+    with _trade_write_lock():
+        for attempt in range(TRADE_WRITE_RETRIES + 1):
+            try:
+                cur = conn.read(worksheet="trade_logs", ttl=0)
+                if key in _trade_ids(cur):
+                    return ("duplicate" if attempt == 0 else status), cur
+                if len(cur) != expected_rows:
+                    status = "merged"
+
+                _append_trade_row(select(worksheet="trade_logs"), cur.columns, row)
+
+                chk = conn.read(worksheet="trade_logs", ttl=0)
+                if key in _trade_ids(chk):
+                    if len(chk) != len(cur) + 1:
+                        status = "merged"  # 讀寫之間別人也寫了：持股交給下次 rerun 整張重算
+                    return status, chk
+            except Exception as e:
+                last_err = e
+            status = "merged"
+            time.sleep(0.2 * (attempt + 1))
+    raise RuntimeError(f"交易寫入失敗（多次重試仍失敗），請重新整理後再試：{last_err}")
+
+def _latest_quote(sym: str):
+    try:
+        h = yf.Ticker(sym).history(period="5d")
+        now_p = float(h["Close"].iloc[-1]) if not h.empty else 0.0
+        prev_p = float(h["Close"].iloc[-2]) if len(h) >= 2 else 0.0
+        return now_p, prev_p
+    except:
+        return 0.0, 0.0
+
+def apply_trade_to_holdings(snapshot: tuple, row: dict) -> tuple:
+    """
+    只更新這筆交易的代號那一列（同 rebuild_data 的平均成本法），
+    淨值用市值差額調整，回傳與 rebuild_data() 相同格式的 tuple。
+    """
+    df_h, df_l, s_dict, nw, rate, symbols, df_div = snapshot
+    sym = normalize_symbol(str(row.get("股票代號", "")))
+    base = df_h.drop(columns=[c for c in DIVIDEND_HOLDING_COLS if c in df_h.columns]) if not df_h.empty else df_h
+    hit = list(base.index[base["代號"] == sym]) if not base.empty else []
+
+    if hit:
+        old = base.loc[hit[0]]
+        pos = {"shares": float(old["持有股數"]), "cost": float(old["總成本(原幣)"]),
+               "currency": old["幣別"], "name": old["名稱"]}
+        now_p = float(old["目前市價(原幣)"])
+        prev_p = now_p / (1.0 + float(old.get("日漲跌(%)", 0.0)) / 100.0)
+        old_mv = float(old["總市值(TWD)"])
+    else:
+        pos = new_position(sym, row)
+        now_p, prev_p = _latest_quote(sym)
+        old_mv = 0.0
+
+    apply_trade_to_position(pos, row)
+    h_row = make_holding_row(sym, pos, now_p, prev_p, rate)
+    keep = pos["shares"] > 0.001
+
+    if hit and keep:
+        base = base.copy()
+        base.loc[hit[0], list(h_row.keys())] = list(h_row.values())
+    elif hit:
+        base = base.drop(index=hit).reset_index(drop=True)
+    elif keep:
+        base = pd.concat([base, pd.DataFrame([h_row])], ignore_index=True)
+
+    df_h2 = attach_dividends(base, df_div)
+    if not df_h2.empty:
+        conn.update(worksheet="holdings", data=df_h2)
+
+    nw2 = nw - old_mv + (h_row["總市值(TWD)"] if keep else 0.0)
+    symbols2 = symbols if sym in symbols else symbols + [sym]
+    return df_h2, df_l, s_dict, nw2, rate, symbols2, df_div
 
 # ==========================================================
 # 4. 主程式介面
@@ -315,7 +1221,7 @@ with st.sidebar:
     st.info("👤 User: admin")
     st.divider()
     if st.button("🚀 更新市價"):
-        st.cache_data.clear()
+        # 即時報價在 rebuild_data 每次重跑都會重抓，不清 st.cache_data（會連模擬/歷史價/股利快取一起清掉）
         st.success("市價同步中...")
         st.rerun()
     if st.button("📈 紀錄淨資產"):
@@ -326,7 +1232,12 @@ with st.sidebar:
         st.session_state["logged_in"] = False
         st.rerun()
 
-df_h, df_l, settings, net_worth, rate, all_symbols = rebuild_data()
+# ✅ 剛送出交易時，直接用送出當下增量更新好的持股，不再整張重算
+_snapshot = st.session_state.pop("holdings_snapshot", None)
+if _snapshot is not None:
+    df_h, df_l, settings, net_worth, rate, all_symbols, df_div = _snapshot
+else:
+    df_h, df_l, settings, net_worth, rate, all_symbols, df_div = rebuild_data()
 
 if st.session_state.get("flash_msg"):
     st.success(st.session_state["flash_msg"])
@@ -341,6 +1252,11 @@ if st.session_state.get("trigger_record"):
     st.success(f"✅ 已紀錄: ${net_worth:,.0f}")
     del st.session_state["trigger_record"]
 
+# ✅ 市價更新後評估警示規則（LTV = 貸款 / 證券總市值）
+_stock_twd = df_h["總市值(TWD)"].sum() if (df_h is not None and not df_h.empty) else 0.0
+ltv_pct = (settings.get("目前貸款金額(TWD)", 0.0) / _stock_twd * 100.0) if _stock_twd > 0 else 0.0
+alert_eval = run_alerts(df_h, net_worth, ltv_pct)
+
 # ======================================================
 # ✅ Top Metrics：資產 / 市值 / 匯率 + 淨現金流 / 已實現損益（基準起始值 + 快照後增量）
 # 你的 Excel 最新值當 baseline，不再把舊 trade_logs 重複加總
@@ -359,15 +1275,6 @@ BASE_REALIZED_COST_TWD = (BASE_REALIZED_PNL_TWD / (BASE_REALIZED_ROI_PCT / 100.0
 # ✅ 你 Excel 這塊通常是「只算股票已實現」；要全算就改 False
 REALIZED_STOCKS_ONLY = True
 
-def _f(x):
-    try:
-        s = str(x).strip()
-        if s == "" or s.lower() in {"none", "nan"}:
-            return 0.0
-        return float(s.replace(",", ""))
-    except:
-        return 0.0
-
 # ======================================================
 # ✅ baseline snapshot time：寫入 settings（只寫一次）
 # Key: baseline_snapshot_ts
@@ -413,52 +1320,21 @@ else:
 # ======================================================
 # ✅ 增量：只算「baseline_snapshot_ts 之後」的新交易
 # ======================================================
-net_cashflow_delta_twd = 0.0
-realized_pnl_delta_twd = 0.0
-realized_cost_delta_twd = 0.0
+# 從增量維護的彙總表取「快照後」的部分，不用每次 iterrows 整張 trade_logs
+trade_rollup = get_trade_rollup(df_l, baseline_snapshot_ts)
+post = trade_rollup[trade_rollup["快照後"]] if not trade_rollup.empty else trade_rollup
+fx_post = np.where(post["幣別"] == "USD", rate, 1.0) if not post.empty else 0.0
 
-if df_l is not None and not df_l.empty:
-    for _, r in df_l.iterrows():
-        ttype = str(r.get("交易類型", "")).strip()
-        if ttype not in ("買入", "賣出"):
-            continue
-
-        # 用建立時間切分增量（沒有建立時間就當作舊資料，不算增量）
-        bt = str(r.get("建立時間", "")).strip()
-        if bt == "" or bt.lower() in {"none", "nan"}:
-            continue
-        try:
-            row_ts = datetime.strptime(bt, "%Y-%m-%d %H:%M:%S")
-        except:
-            continue
-
-        if row_ts <= baseline_snapshot_ts:
-            continue  # ✅ baseline 以前的不算增量
+# 淨現金流：買入(負)、賣出(正)
+net_cashflow_delta_twd = float((post["淨現金流"] * fx_post).sum()) if not post.empty else 0.0
 
-        sym = normalize_symbol(str(r.get("股票代號", "")).strip())
-        cur = str(r.get("幣別", "")).strip().upper() or infer_currency(sym)
-        fx = rate if cur == "USD" else 1.0
-
-        net_org = _f(r.get("應收付(原幣)", 0))
-        net_twd = net_org * fx
-
-        # 淨現金流：買入(負)、賣出(正)
-        if ttype == "買入":
-            net_cashflow_delta_twd -= net_twd
-        else:
-            net_cashflow_delta_twd += net_twd
-
-            # 已實現：只統計賣出
-            if REALIZED_STOCKS_ONLY and get_mapping(sym).get("類別") != "股票":
-                continue
-
-            sell_cost_org = _f(r.get("成本(原幣)※賣出需填", 0))
-            profit_org = _f(r.get("損益(原幣)", 0))
-            if profit_org == 0.0:
-                profit_org = (net_org - sell_cost_org)
-
-            realized_pnl_delta_twd += profit_org * fx
-            realized_cost_delta_twd += sell_cost_org * fx
+# 已實現：只統計賣出（REALIZED_STOCKS_ONLY 時只算「股票」類別）
+if REALIZED_STOCKS_ONLY and not post.empty:
+    is_stock = post["代號"].map(lambda x: get_mapping(x).get("類別") == "股票").to_numpy(dtype=bool)
+else:
+    is_stock = True
+realized_pnl_delta_twd = float((post["已實現損益"] * fx_post * is_stock).sum()) if not post.empty else 0.0
+realized_cost_delta_twd = float((post["已實現成本"] * fx_post * is_stock).sum()) if not post.empty else 0.0
 
 # ======================================================
 # ✅ 最終顯示：baseline + 增量
@@ -481,15 +1357,27 @@ m4.metric("淨現金流(TWD)（正=錢回收、負=支出）", f"{net_cashflow_t
 m5.metric("已實現總損益(TWD)", f"{realized_pnl_total_twd:,.0f}")
 m6.metric("已實現總損益(%)", f"{realized_roi_total_pct:.2f}%")
 
+# 第三排：配息 / 未實現 / 含息總損益（已實現 + 未實現 + 配息）
+dividends_total_twd = df_div["實領(TWD)"].sum() if (df_div is not None and not df_div.empty) else 0.0
+unrealized_total_twd = df_h["未實現損益(TWD)"].sum() if (df_h is not None and not df_h.empty) else 0.0
+m7, m8, m9 = st.columns(3)
+m7.metric("累計配息(TWD)（實領）", f"{dividends_total_twd:,.0f}")
+m8.metric("未實現損益(TWD)", f"{unrealized_total_twd:,.0f}")
+m9.metric("含息總損益(TWD)", f"{realized_pnl_total_twd + unrealized_total_twd + dividends_total_twd:,.0f}")
+
 st.divider()
 
-NAVS = ["📊 視覺化分析", "➕ 新增交易", "📝 交易紀錄 & 績效", "⚙️ 資金設定"]
+NAVS = ["📊 視覺化分析", "🛡️ 風險分析", "⚖️ 再平衡", "🎲 淨值模擬", "🔔 警示", "➕ 新增交易", "📝 交易紀錄 & 績效", "⚙️ 資金設定"]
 if "nav_choice" not in st.session_state:
     st.session_state["nav_choice"] = NAVS[0]
 if "pending_nav" in st.session_state:
     st.session_state["nav_choice"] = st.session_state.pop("pending_nav")
 
 nav = st.radio("", NAVS, horizontal=True, key="nav_choice")
+# ✅ 從別的分頁切進新增交易 = 新的一張單，草稿 ID 重發
+if nav != st.session_state.get("last_nav"):
+    st.session_state.pop("trade_draft_id", None)
+st.session_state["last_nav"] = nav
 
 # ==========================================================
 # 5. 各頁面
@@ -549,6 +1437,233 @@ if nav == "📊 視覺化分析":
                 use_container_width=True
             )
 
+elif nav == "🛡️ 風險分析":
+    if df_h.empty:
+        st.info("尚無持股")
+    else:
+        with st.spinner("載入日價格矩陣..."):
+            store = get_price_matrix(sorted(set(SYMBOL_MAP.keys()) | set(df_h["代號"])))
+
+        if store["px"].empty:
+            st.warning("抓不到歷史價格，請稍後再試")
+        else:
+            weights = df_h.groupby("代號")["總市值(TWD)"].sum()
+            report = compute_risk_report(store, weights)
+            port = report["portfolio"]
+
+            st.caption(f"資料區間：{report['start']} ~ {report['end']}（約 {report['days']} 個交易日，USD 資產以台幣計）")
+            r1, r2, r3, r4 = st.columns(4)
+            r1.metric("組合年化波動", f"{port['年化波動(%)']:.2f}%")
+            r2.metric("組合最大回撤", f"{port['最大回撤(%)']:.2f}%")
+            r3.metric("Beta vs 0050", f"{port['Beta(0050.TW)']:.2f}")
+            r4.metric("Beta vs VT", f"{port['Beta(VT)']:.2f}")
+
+            df_risk = report["per"].copy()
+            df_risk.insert(0, "投資組合", [get_mapping(s)["組合"] for s in df_risk.index])
+            st.dataframe(
+                df_risk.sort_values("權重(%)", ascending=False).style.format(
+                    {c: "{:.2f}" for c in df_risk.columns if c != "投資組合"}, na_rep="—"
+                ),
+                use_container_width=True
+            )
+
+            fig = px.imshow(
+                report["corr"], text_auto=".2f", zmin=-1, zmax=1,
+                color_continuous_scale="RdBu_r", title="日報酬相關係數"
+            )
+            st.plotly_chart(fig, use_container_width=True)
+
+elif nav == "⚖️ 再平衡":
+    # ✅ 用 fragment：拉滑桿只重跑這一塊，不會重新讀 Sheet / 抓市價
+    @st.fragment
+    def rebalance_panel():
+        if df_h.empty:
+            st.info("尚無持股")
+            return
+
+        cash_twd = (
+            settings.get("目前帳戶現金(TWD)", 0.0)
+            + settings.get("交割中現金(TWD)", 0.0)
+            + settings.get("美元現金(USD)", 0.0) * rate
+        )
+        loan = settings.get("目前貸款金額(TWD)", 0.0)
+
+        o1, o2, o3 = st.columns(3)
+        tw_board_lot = o1.checkbox("台股以整張(1000股)下單", value=False)
+        reserve_loan = o2.checkbox("預留還款（貸款金額不參與配置）", value=False)
+        contrib = o3.number_input("本次加碼(TWD)", value=0.0, step=10000.0)
+
+        lines = build_rebalance_lines(df_h, tw_board_lot)
+        groups = rebalance_groups(lines)
+        cur_w = groups / groups.sum()
+
+        st.markdown("#### 🎯 目標權重 (%)")
+        cols = st.columns(3)
+        raw_t = []
+        for i, (grp, w0) in enumerate(cur_w.items()):
+            raw_t.append(cols[i % 3].slider(grp, 0.0, 100.0, float(round(w0 * 100.0, 1)), 0.5, key=f"target_{grp}"))
+        raw_t = np.array(raw_t, dtype=float)
+        if raw_t.sum() <= 0:
+            st.error("目標權重合計必須大於 0")
+            return
+        if abs(raw_t.sum() - 100.0) > 0.01:
+            st.caption(f"目標合計 {raw_t.sum():.1f}%，已自動等比例換算成 100%")
+        targets = raw_t / raw_t.sum()
+
+        s1, s2 = st.columns(2)
+        c_lo, c_hi = s1.slider("情境：加碼金額區間(TWD)", -1_000_000, 3_000_000, (0, 1_000_000), 50_000)
+        n_sc = s2.slider("情境數", 2, 200, 21)
+        scenarios = np.concatenate([[contrib], np.linspace(c_lo, c_hi, n_sc)])
+
+        res = rebalance_batch(lines, targets, cash_twd, loan if reserve_loan else 0.0, scenarios)
+
+        df_grp = pd.DataFrame({
+            "投資組合": groups.index,
+            "目前權重(%)": cur_w.to_numpy() * 100.0,
+            "目標權重(%)": targets * 100.0,
+            "金額(TWD)": res["group_notional"][0],
+            "交易後權重(%)": res["post_weights"][0] * 100.0,
+        })
+        df_plan = pd.DataFrame({
+            "投資組合": lines["投資組合"],
+            "代號": lines["代號"],
+            "持有股數": lines["持有股數"],
+            "股數(+買/-賣)": res["shares"][0],
+            "金額(TWD)": res["notional"][0],
+            "費用(TWD)": res["fees"][0],
+        })
+
+        p1, p2, p3 = st.columns(3)
+        p1.metric("買入總額", f"{df_plan.loc[df_plan['金額(TWD)'] > 0, '金額(TWD)'].sum():,.0f}")
+        p2.metric("賣出總額", f"{-df_plan.loc[df_plan['金額(TWD)'] < 0, '金額(TWD)'].sum():,.0f}")
+        p3.metric("交易後現金", f"{res['cash_after'][0]:,.0f}")
+        st.dataframe(
+            df_grp.style.format({
+                "目前權重(%)": "{:.2f}", "目標權重(%)": "{:.2f}", "交易後權重(%)": "{:.2f}", "金額(TWD)": "{:,.0f}",
+            }),
+            use_container_width=True
+        )
+        st.dataframe(
+            df_plan[df_plan["股數(+買/-賣)"] != 0].style.format({
+                "持有股數": "{:,.4f}", "股數(+買/-賣)": "{:,.4f}", "金額(TWD)": "{:,.0f}", "費用(TWD)": "{:,.0f}",
+            }),
+            use_container_width=True
+        )
+
+        st.markdown("#### 🔀 What-if 情境")
+        df_sc = pd.DataFrame({
+            "加碼(TWD)": scenarios[1:],
+            "買入總額": np.where(res["notional"] > 0, res["notional"], 0.0).sum(axis=1)[1:],
+            "賣出總額": -np.where(res["notional"] < 0, res["notional"], 0.0).sum(axis=1)[1:],
+            "費用": res["fees"].sum(axis=1)[1:],
+            "交易後現金": res["cash_after"][1:],
+            "最大偏離(%)": res["max_drift"][1:] * 100.0,
+        })
+        st.dataframe(df_sc.style.format("{:,.0f}", subset=df_sc.columns[:-1]).format("{:.2f}", subset=["最大偏離(%)"]),
+                     use_container_width=True)
+
+    rebalance_panel()
+
+elif nav == "🎲 淨值模擬":
+    if df_h.empty:
+        st.info("尚無持股")
+    else:
+        with st.spinner("載入日價格矩陣..."):
+            store = get_price_matrix(sorted(set(SYMBOL_MAP.keys()) | set(df_h["代號"])))
+
+        if store["px"].empty:
+            st.warning("抓不到歷史價格，請稍後再試")
+        else:
+            loan_now = settings.get("目前貸款金額(TWD)", 0.0)
+            cash_now = (
+                settings.get("目前帳戶現金(TWD)", 0.0)
+                + settings.get("交割中現金(TWD)", 0.0)
+                + settings.get("美元現金(USD)", 0.0) * rate
+            )
+
+            with st.form("mc_form"):
+                f1, f2, f3 = st.columns(3)
+                years = f1.slider("模擬年數", 1, 30, 10)
+                n_paths = f2.select_slider("路徑數", options=[5000, 10000, 20000, 50000], value=20000)
+                ltv_limit = f3.number_input("LTV 警戒線(%)", value=60.0, step=5.0) / 100.0
+                f4, f5, f6 = st.columns(3)
+                loan_rate = f4.number_input("貸款年利率(%)", value=2.5, step=0.1) / 100.0
+                contrib = f5.number_input("每月投入(TWD)", value=0.0, step=5000.0)
+                repay = f6.number_input("每月還本(TWD)", value=0.0, step=5000.0)
+                st.form_submit_button("開始模擬")
+
+            weights = df_h.groupby("代號")["總市值(TWD)"].sum()
+            syms, mu_m, cov_m, w = holding_return_params(store, weights)
+
+            # ✅ 輸入先取整，市價小幅跳動時仍命中快取
+            with st.spinner("模擬中..."):
+                try:
+                    sim = simulate_net_worth(
+                        np.round(mu_m, 6), np.round(cov_m, 8), np.round(w, 4),
+                        float(round(weights.sum(), -4)), float(round(cash_now, -3)), float(loan_now),
+                        float(loan_rate), float(contrib), float(repay), int(years * 12),
+                        int(n_paths), float(ltv_limit)
+                    )
+                except np.linalg.LinAlgError as e:
+                    st.error(f"報酬共變異矩陣無法分解，請稍後再試：{e}")
+                    st.stop()
+
+            band = sim["bands"].copy()
+            band.index = band.index / 12.0
+            k1, k2, k3 = st.columns(3)
+            k1.metric(f"{years} 年後淨值中位數", f"${band['P50'].iloc[-1]:,.0f}")
+            k2.metric("P5 ~ P95", f"${band['P5'].iloc[-1]:,.0f} ~ ${band['P95'].iloc[-1]:,.0f}")
+            k3.metric(f"LTV 觸及 {ltv_limit * 100:.0f}% 機率", f"{sim['breach_prob'] * 100:.2f}%")
+
+            fig = px.line(band, labels={"index": "年", "value": "資產總淨值(TWD)", "variable": "百分位"},
+                          title="淨值百分位區間")
+            st.plotly_chart(fig, use_container_width=True)
+
+            df_b = pd.DataFrame({"年": sim["breach_curve"].index / 12.0, "累積觸及機率(%)": sim["breach_curve"].to_numpy() * 100.0})
+            st.plotly_chart(px.area(df_b, x="年", y="累積觸及機率(%)", title="LTV 警戒累積機率"), use_container_width=True)
+            st.caption(f"報酬參數取自 {', '.join(syms)} 的歷史日報酬（以台幣計），每月依目前權重再平衡。")
+
+elif nav == "🔔 警示":
+    st.subheader("🔔 警示規則")
+    st.caption(
+        "價格/日漲跌：目標填代號；配置偏離：目標填投資組合並填目標權重；淨值/LTV：目標留空。"
+        "同一規則條件持續成立只會發一次，解除後再成立且超過冷卻時間才會再發。"
+    )
+    rules_now = load_alert_rules()
+    rules_now["啟用"] = rules_now["啟用"].map(lambda v: str(v).strip().lower() in ("true", "1", "y", "yes", "是"))
+    edited = st.data_editor(
+        rules_now,
+        num_rows="dynamic",
+        use_container_width=True,
+        column_config={
+            "啟用": st.column_config.CheckboxColumn("啟用", default=True),
+            "類型": st.column_config.SelectboxColumn("類型", options=ALERT_TYPES, required=True),
+            "門檻": st.column_config.NumberColumn("門檻"),
+            "目標權重(%)": st.column_config.NumberColumn("目標權重(%)"),
+            "冷卻(分鐘)": st.column_config.NumberColumn("冷卻(分鐘)", default=60),
+        },
+        key="alert_rules_editor",
+    )
+    if st.button("💾 儲存規則"):
+        try:
+            save_alert_rules(edited)
+        except Exception as e:
+            st.error(f"❌ 規則儲存失敗：{e}")
+        else:
+            st.session_state["pending_nav"] = "🔔 警示"
+            st.session_state["flash_msg"] = "✅ 警示規則已更新！"
+            st.rerun()
+
+    if alert_eval is not None and not alert_eval.empty:
+        st.markdown("#### 目前狀態")
+        st.dataframe(
+            alert_eval[["類型", "目標", "門檻", "數值", "成立"]].style.format({"數值": "{:,.2f}"}, na_rep="—"),
+            use_container_width=True
+        )
+
+    st.markdown("#### 🕘 觸發紀錄")
+    st.dataframe(read_alert_history(), use_container_width=True)
+
 elif nav == "➕ 新增交易":
     st.subheader("➕ 新增交易（賣出：必填成本；應收付可手填；送出即自動算損益/報酬率）")
 
@@ -571,6 +1686,10 @@ elif nav == "➕ 新增交易":
         if c not in df_l.columns:
             df_l[c] = ""
 
+    # ✅ 草稿 ID 在開表單時就固定，連點/重試送出時冪等鍵才會相同；建立時間則在送出時才蓋
+    if "trade_draft_id" not in st.session_state:
+        st.session_state["trade_draft_id"] = os.urandom(8).hex()
+
     with st.form("add_trade", clear_on_submit=True):
         c1, c2 = st.columns(2)
         d_date = c1.date_input("日期", datetime.now())
@@ -699,13 +1818,21 @@ elif nav == "➕ 新增交易":
 
                     "建立時間": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 })
+                row_data["交易ID"] = trade_idempotency_key(row_data, st.session_state["trade_draft_id"])
+
+                status, df_l2 = commit_trade(row_data, len(df_l))
 
-                df_new = pd.DataFrame([row_data], columns=df_l.columns)
-                df_l2 = pd.concat([df_l, df_new], ignore_index=True)
-                conn.update(worksheet="trade_logs", data=df_l2)
+                # 持股：沒有別人同時寫入時只增量更新這一檔；有合併就下次 rerun 整張重算
+                if status == "committed":
+                    st.session_state["holdings_snapshot"] = apply_trade_to_holdings(
+                        (df_h, df_l2, settings, net_worth, rate, all_symbols, df_div), row_data
+                    )
+                st.session_state.pop("trade_draft_id", None)
 
-                # 重算 holdings
-                rebuild_data()
+                if status == "duplicate":
+                    st.session_state["pending_nav"] = "➕ 新增交易"
+                    st.session_state["flash_msg"] = f"ℹ️ 這筆交易已寫入過（{row_data['交易ID']}），未重複新增"
+                    st.rerun()
 
                 extra = f"｜應收付:{net_receivable:,.4f}｜市值(TWD):{mv_twd_trade:,.0f}"
                 if d_type == "賣出":
@@ -713,13 +1840,37 @@ elif nav == "➕ 新增交易":
 
                 st.session_state["pending_nav"] = "➕ 新增交易"
                 st.session_state["flash_msg"] = f"✅ 已寫入交易：{d_type} {d_sym} {float(d_shares)} 股 @ {float(d_price)}{extra}"
-                st.cache_data.clear()
                 st.rerun()
 
-            except ValueError as e:
+            except (ValueError, RuntimeError) as e:
                 st.error(str(e))
 
 elif nav == "📝 交易紀錄 & 績效":
+    st.subheader("📈 績效報表")
+    REPORT_DIMS = {
+        "月份": ["月份"],
+        "年度": ["年度"],
+        "代號": ["代號"],
+        "平台 / 帳戶類型": ["平台", "帳戶類型"],
+    }
+    r1, r2 = st.columns([3, 1])
+    dim = r1.radio("彙總方式", list(REPORT_DIMS.keys()), horizontal=True)
+    only_post = r2.checkbox("只看快照後", value=False)
+
+    rollup_view = trade_rollup[trade_rollup["快照後"]] if (only_post and not trade_rollup.empty) else trade_rollup
+    df_rep = rollup_report(rollup_view, REPORT_DIMS[dim], rate)
+    st.dataframe(
+        df_rep.style.format({c: "{:,.0f}" for c in df_rep.columns if c.endswith("(TWD)")} | {"ROI(%)": "{:.2f}%"}),
+        use_container_width=True
+    )
+    st.download_button(
+        "⬇️ 匯出 CSV",
+        df_rep.to_csv(index=False).encode("utf-8-sig"),
+        file_name=f"performance_by_{'_'.join(REPORT_DIMS[dim])}.csv",
+        mime="text/csv"
+    )
+
+    st.subheader("🧾 交易明細")
     # ✅ 顯示格式：
     # - TWD 金額：不顯示小數
     # - 台股股數：不顯示小數
@@ -786,6 +1937,20 @@ elif nav == "📝 交易紀錄 & 績效":
 
     st.dataframe(df_view.style.format(fmt), use_container_width=True)
 
+    st.subheader("💵 配息紀錄")
+    if df_div is None or df_div.empty:
+        st.info("持有期間尚無配息")
+    else:
+        df_div_view = df_div.copy()
+        df_div_view["除息日"] = df_div_view["除息日"].dt.strftime("%Y/%m/%d")
+        st.dataframe(
+            df_div_view.style.format({
+                "每股配息": "{:,.4f}", "持有股數": fmt_share, "配息(原幣)": fmt_num,
+                "預扣稅(原幣)": fmt_num, "實領(原幣)": fmt_num, "實領(TWD)": "{:,.0f}",
+            }),
+            use_container_width=True
+        )
+
 elif nav == "⚙️ 資金設定":
     c1, c2 = st.columns(2)
     v_twd = c1.number_input("TWD 現金", value=settings.get("目前帳戶現金(TWD)", 0))
@@ -803,5 +1968,4 @@ elif nav == "⚙️ 資金設定":
         conn.update(worksheet="settings", data=new_s)
         st.session_state["pending_nav"] = "⚙️ 資金設定"
         st.session_state["flash_msg"] = "✅ 設定已更新！"
-        st.cache_data.clear()
         st.rerun()